@@ -1,13 +1,82 @@
+import difflib
+import functools
+import heapq
 import os
-import re
-import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import git
-from colorama import Fore, Style
 
 from repo_agent.file_handler import FileHandler
+from repo_agent.log import logger
 from repo_agent.settings import setting
 
+# 只需要变更行，不需要上下文行和颜色
+_DIFF_ARGS = ("--unified=0", "--no-color")
+
+# 每次 git add / git diff 最多传入的路径数量
+_GIT_PATHS_BATCH_SIZE = 500
+
+# 不超过该大小（字节）的文件在进程内计算 diff，不再启动 git diff
+_IN_PROCESS_DIFF_MAX_SIZE = 50 * 1024
+
+# 没有设置任何会改变文件内容的属性（换行符转换、过滤器、ident、编码转换）的 .py 文件
+_PLAIN_PYS_PATHSPEC = ":(attr:!text !eol !filter !ident !working-tree-encoding)*.py"
+
+
+def _iter_process_lines(process):
+    """
+    逐行读取 git 子进程的输出，避免先把整个 diff 读成一个大字符串再 splitlines。
+    读取结束后等待进程退出，git 返回非零状态码时会抛出 GitCommandError。
+    """
+    try:
+        for line in process.stdout:
+            yield line.decode("utf-8", errors="replace").rstrip("\r\n")
+    finally:
+        process.wait()
+
+
+def _parse_hunk_header(line):
+    """
+    解析 diff 中的行号信息，例如 "@@ -43,33 +43,40 @@"；行数为 1 时 git 会省略它，例如 "@@ -43 +43 @@"。
+    hunk 头的格式固定，用 split 取出起始行号，不经过正则引擎。格式不对时返回 None。
+    """
+    parts = line.split(" ", 3)
+    if len(parts) < 4 or parts[2][:1] != "+" or not parts[3].startswith("@@"):
+        return None
+    try:
+        return int(parts[1][1:].partition(",")[0]), int(parts[2][1:].partition(",")[0])
+    except ValueError:
+        return None
+
+
+def _split_lines(text):
+    """
+    按 "\n" 切分文件内容，与 git 和 ast 的行号保持一致。
+    str.splitlines 还会在换页符 (\x0c)、\v、\x1c-\x1e、\x85、\u2028、\u2029 处断行，会让之后的行号全部错位。
+    """
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def _iter_unified_diff(previous_lines, current_lines):
+    """
+    以 git diff --unified=0 的格式逐个输出 hunk，供 parse_diffs 解析。
+    关闭 autojunk，避免大文件中出现频率高的行（空行、括号）被当作噪声，导致 hunk 比实际变更更大。
+    """
+    matcher = difflib.SequenceMatcher(None, previous_lines, current_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        yield f"@@ -{i1 + 1},{i2 - i1} +{j1 + 1},{j2 - j1} @@"
+        # 比较时保留行尾的 "\r"，输出时去掉，与 _iter_process_lines 读取 git 输出的结果一致
+        for line in previous_lines[i1:i2]:
+            yield "-" + line.rstrip("\r")
+        for line in current_lines[j1:j2]:
+            yield "+" + line.rstrip("\r")
+
 
 class ChangeDetector:
     """
@@ -26,7 +95,100 @@ class ChangeDetector:
         None
         """
         self.repo_path = repo_path
-        self.repo = git.Repo(repo_path)
+        # git.Repo 在第一次使用时才打开，见 repo 属性
+        self._repo = None
+        self._repo_lock = threading.Lock()
+        # 暂存区相对 HEAD 的变更缓存，以及生成该缓存时暂存区和 HEAD 的状态
+        self._staged_entries = None
+        self._staged_entries_key = None
+        # get_staged_pys 的结果，与生成它的 _staged_entries 一起保存
+        self._staged_pys = None
+        # 可以在进程内比较的文件，见 _get_plain_pys
+        self._plain_pys = None
+        self._plain_pys_lock = threading.Lock()
+        self._object_read_lock = threading.Lock()
+
+    @property
+    def repo(self):
+        """
+        The git.Repo of the repository, opened on first use.
+
+        Returns:
+            git.Repo: The repository object shared by all methods of this detector.
+        """
+        repo = self._repo
+        if repo is None:
+            # 线程池中的多个线程可能同时第一次访问，只打开一次
+            with self._repo_lock:
+                repo = self._repo
+                if repo is None:
+                    self._repo = repo = git.Repo(self.repo_path)
+        return repo
+
+    def invalidate_caches(self):
+        """
+        Drop the cached staged changes, so the next query reads them from git again.
+        """
+        self._staged_entries = None
+        self._staged_entries_key = None
+        self._staged_pys = None
+        self._plain_pys = None
+
+    def _stage_files(self, file_paths):
+        """
+        Add the given files to the staging area with a single git add invocation per batch of paths.
+
+        git add is used rather than the in-process GitPython index.add, because the files to stage may include deletions,
+        which index.add cannot stage, and git keeps the index extensions it maintains intact.
+
+        Args:
+            file_paths (list): The relative paths of the files to stage.
+        """
+        if not file_paths:
+            return
+        # 路径过多时分批调用，避免超出命令行长度限制（Windows 上约为 32KB）
+        for start in range(0, len(file_paths), _GIT_PATHS_BATCH_SIZE):
+            self.repo.git.add("--", *file_paths[start : start + _GIT_PATHS_BATCH_SIZE])
+        self.invalidate_caches()
+
+    def _get_staged_entries(self):
+        """
+        Get the changes of Python files in the staging area relative to HEAD as a list of (change_type, path) tuples.
+
+        The result backs get_staged_pys and is reused until the index file or HEAD changes,
+        so a detection cycle only diffs the staging area once.
+
+        Returns:
+            list: A list of (change_type, path) tuples, where change_type is the status letter reported by git (with the similarity score for renames and copies).
+        """
+        repo = self.repo
+        try:
+            index_stat = os.stat(repo.index.path)
+            cache_key = (index_stat.st_mtime_ns, index_stat.st_size, repo.head.commit.hexsha)
+        except (OSError, ValueError):
+            cache_key = None
+        if self._staged_entries is not None and cache_key is not None and cache_key == self._staged_entries_key:
+            return self._staged_entries
+
+        # `git diff --staged HEAD` treats the last commit (HEAD) as the old state and the staging area (index) as the new state, so a new file in the staging area is reported as added ("A").
+        # Only the change type and the path are needed, so the raw `--name-status -z` output is parsed directly instead of building GitPython Diff objects for every staged entry.
+        # With -z every field is terminated by NUL; renames and copies ("R"/"C") are followed by both the old and the new path, and the new path is kept.
+        # 通过 pathspec 让 git 只输出 .py 文件，其他文件的变更不会被读取和解析
+        staged_entries = []
+        entries = iter(
+            repo.git.diff("--staged", "--name-status", "-z", "HEAD", "--", "*.py").split("\0")
+        )
+        for change_type in entries:
+            if not change_type:
+                continue
+            path = next(entries, "")
+            if change_type[0] in ("R", "C"):
+                path = next(entries, "")
+            staged_entries.append((change_type, path))
+
+        self._staged_entries = staged_entries
+        self._staged_entries_key = cache_key
+        return staged_entries
 
     def get_staged_pys(self):
         """
@@ -39,46 +201,250 @@ class ChangeDetector:
             dict: A dictionary of changed Python files, where the keys are the file paths and the values are booleans indicating whether the file is newly created or not.
 
         """
-        repo = self.repo
+        staged_entries = self._get_staged_entries()
+        # The result is memoized until the staged changes it was built from are read again from git.
+        if self._staged_pys is not None and self._staged_pys[0] is staged_entries:
+            return dict(self._staged_pys[1])
+
         staged_files = {}
         # Detect Staged Changes
-        # Please note! The logic of the GitPython library is different from git. Here, the R=True parameter is used to reverse the version comparison logic.
-        # In the GitPython library, repo.index.diff('HEAD') compares the staging area (index) as the new state with the original HEAD commit (old state). This means that if there is a new file in the current staging area, it will be shown as non-existent in HEAD, i.e., "deleted".
-        # R=True reverses this logic, correctly treating the last commit (HEAD) as the old state and comparing it with the current staging area (new state) (Index). In this case, a new file in the staging area will correctly show as added because it does not exist in HEAD.
-        diffs = repo.index.diff("HEAD", R=True)
-
-        for diff in diffs:
-            if diff.change_type in ["A", "M"] and diff.a_path.endswith(".py"):
-                is_new_file = diff.change_type == "A"
-                staged_files[diff.a_path] = is_new_file
+        # Renames and copies are reported with a similarity score (e.g. "R100") and are not treated as added or modified files.
+        for change_type, path in staged_entries:
+            if change_type in ("A", "M") and path.endswith(".py"):
+                staged_files[path] = change_type == "A"
 
-        return staged_files
+        self._staged_pys = (staged_entries, staged_files)
+        return dict(staged_files)
 
     def get_file_diff(self, file_path, is_new_file):
         """
         The function's purpose is to retrieve the changes made to a specific file. For new files, it uses git diff --staged to get the differences.
+        The diff is produced without context lines, since only the added and removed lines are used.
         Args:
             file_path (str): The relative path of the file
             is_new_file (bool): Indicates whether the file is a new file
         Returns:
-            list: List of changes made to the file
+            Iterator[str]: Lines of the changes made to the file, read lazily from the git process
         """
-        repo = self.repo
-
         if is_new_file:
             # For new files, first add them to the staging area.
-            add_command = f'git -C {repo.working_dir} add {file_path}'
-            subprocess.run(add_command, shell=True, check=True)
+            self._stage_files([file_path])
+
+        return self._diff_file(file_path, is_new_file)
+
+    def get_file_diffs(self, files):
+        """
+        Retrieve the changes made to several files at once.
+        New files are staged together with a single git add first, then the git diff of every file runs in a thread pool,
+        so the diff workers never touch the staging area.
+        Args:
+            files (dict): A dictionary of file paths and whether each file is a new file, as returned by get_staged_pys()
+        Returns:
+            dict: A dictionary mapping each file path to the list of changes made to the file
+        """
+        return self._map_file_diffs(files, lambda file_path, diffs: list(diffs))
+
+    def parse_file_diffs(self, files):
+        """
+        Retrieve and parse the changes made to several files at once.
+        Each worker of the thread pool diffs one file and parses its output while it is being read;
+        only large files that share one git diff have their lines collected per file first.
+        Args:
+            files (dict): A dictionary of file paths and whether each file is a new file, as returned by get_staged_pys()
+        Returns:
+            dict: A dictionary mapping each file path to its added and deleted line information, in the same format as parse_diffs()
+        """
+        return self._map_file_diffs(files, lambda file_path, diffs: self.parse_diffs(diffs))
+
+    def identify_file_changes(self, files):
+        """
+        Identify the changed structures of several files at once.
+        Each worker of the thread pool diffs one file, parses its structures and matches the changed lines against them,
+        so the git diff of one file overlaps with the reading and parsing of the others.
+        Args:
+            files (dict): A dictionary of file paths and whether each file is a new file, as returned by get_staged_pys()
+        Returns:
+            dict: A dictionary mapping each file path to its changed structures, in the same format as identify_changes_in_structure()
+        """
+        return self._map_file_diffs(files, self._identify_file_changes)
+
+    def _identify_file_changes(self, file_path, diffs):
+        file_handler = FileHandler(repo_path=self.repo.working_dir, file_path=file_path)
+        return self.identify_changes_in_structure(
+            self.iter_changed_lines(diffs),
+            file_handler.get_functions_and_classes(file_handler.read_file()),
+        )
+
+    def _map_file_diffs(self, files, func):
+        """
+        Stage the new files with a single git add, then call func(file_path, diff_lines) for every file in a thread pool.
+        Files too large to be compared in process are diffed together, one git diff per batch of paths, instead of one git process per file.
+        """
+        new_files = [file_path for file_path, is_new_file in files.items() if is_new_file]
+        self._stage_files(new_files)
+
+        large_files = {True: [], False: []}
+        for file_path, is_new_file in files.items():
+            if self._is_large_file(file_path):
+                large_files[is_new_file].append(file_path)
+        batches = [
+            (file_paths[start : start + _GIT_PATHS_BATCH_SIZE], is_new_file)
+            for is_new_file, file_paths in large_files.items()
+            if len(file_paths) > 1
+            for start in range(0, len(file_paths), _GIT_PATHS_BATCH_SIZE)
+        ]
+        batched_files = {file_path for file_paths, _ in batches for file_path in file_paths}
+
+        def diff_and_apply(file_path, is_new_file):
+            return func(file_path, self._diff_file(file_path, is_new_file))
+
+        with ThreadPoolExecutor(max_workers=setting.project.max_thread_count) as executor:
+            batch_futures = [
+                (file_paths, is_new_file, executor.submit(self._diff_files_together, file_paths, is_new_file))
+                for file_paths, is_new_file in batches
+            ]
+            futures = {
+                file_path: executor.submit(diff_and_apply, file_path, is_new_file)
+                for file_path, is_new_file in files.items()
+                if file_path not in batched_files
+            }
+            for file_paths, is_new_file, batch_future in batch_futures:
+                file_diffs = batch_future.result()
+                for file_path in file_paths:
+                    if file_path in file_diffs:
+                        futures[file_path] = executor.submit(func, file_path, file_diffs[file_path])
+                    else:
+                        # 无法从合并的输出中识别出该文件时，单独 diff
+                        futures[file_path] = executor.submit(diff_and_apply, file_path, is_new_file)
+            return {file_path: futures[file_path].result() for file_path in files}
+
+    def _is_large_file(self, file_path):
+        """
+        Check whether a file is too large to be compared in process by _diff_small_file.
+        """
+        try:
+            return os.path.getsize(os.path.join(self.repo.working_dir, file_path)) > _IN_PROCESS_DIFF_MAX_SIZE
+        except OSError:
+            return True
+
+    def _diff_files_together(self, file_paths, is_new_file):
+        """
+        Run one git diff for several files and split its output into the lines of each file.
+
+        Args:
+            file_paths (list): The relative paths of the files, all new files or all existing files.
+            is_new_file (bool): Whether the files are new files, which are diffed from the staging area.
 
+        Returns:
+            dict: A dictionary mapping each file path to its diff lines. Paths whose section could not be recognised,
+                for example because git quoted a path with special characters, are left out so the caller can diff them separately.
+        """
+        # 关闭重命名检测，保证每个文件的头部都是 "diff --git a/<path> b/<path>"
+        process = self.repo.git.diff(
+            *_DIFF_ARGS, "--no-renames", "--staged" if is_new_file else "HEAD", "--", *file_paths, as_process=True
+        )
+        headers = {f"diff --git a/{file_path} b/{file_path}": file_path for file_path in file_paths}
+        file_diffs = {}
+        all_recognised = True
+        lines = None
+        for line in _iter_process_lines(process):
+            if line.startswith("diff --git "):
+                file_path = headers.get(line)
+                if file_path is None:
+                    all_recognised = False
+                    lines = None
+                else:
+                    lines = file_diffs[file_path] = [line]
+            elif lines is not None:
+                lines.append(line)
+        if all_recognised:
+            # 没有出现在输出中的文件没有变更
+            for file_path in file_paths:
+                file_diffs.setdefault(file_path, [])
+        return file_diffs
+
+    def _diff_file(self, file_path, is_new_file):
+        """
+        Start git diff for a file that is already in the expected state and return its output lines lazily.
+        Small text files are compared in process instead, which saves starting a git process per file.
+        """
+        diffs = self._diff_small_file(file_path, is_new_file)
+        if diffs is not None:
+            return diffs
+
+        if is_new_file:
             # Get the diff from the staging area.
-            diffs = repo.git.diff("--staged", file_path).splitlines()
+            process = self.repo.git.diff(*_DIFF_ARGS, "--staged", file_path, as_process=True)
         else:
             # For non-new files, get the diff from HEAD.
-            diffs = repo.git.diff("HEAD", file_path).splitlines()
+            process = self.repo.git.diff(*_DIFF_ARGS, "HEAD", file_path, as_process=True)
+
+        return _iter_process_lines(process)
+
+    def _get_plain_pys(self):
+        """
+        Get the Python files in the staging area whose working tree content is exactly what git diff compares.
+
+        git diff HEAD compares the working tree file after git's clean conversion: core.autocrlf, the text and eol attributes,
+        filters, ident and working-tree-encoding all make the raw bytes differ from the content git compares.
+        Files affected by any of them are left out, so _diff_small_file falls back to git diff for them.
+        The attributes are resolved by git itself, so every gitattributes file (system, global, info and in-tree) is honoured.
+
+        Returns:
+            frozenset: The relative paths of the files, empty when core.autocrlf is enabled.
+        """
+        plain_pys = self._plain_pys
+        if plain_pys is None:
+            repo = self.repo
+            with self._plain_pys_lock:
+                plain_pys = self._plain_pys
+                if plain_pys is None:
+                    try:
+                        autocrlf = repo.git.config("--get", "core.autocrlf")
+                    except git.GitCommandError:
+                        # 未设置时 git config 以状态码 1 退出
+                        autocrlf = "false"
+                    if autocrlf.strip().lower() not in ("false", "no", "off", "0", ""):
+                        # core.autocrlf 对所有文本文件生效（例如 Git for Windows 默认的 true）
+                        plain_pys = frozenset()
+                    else:
+                        plain_pys = frozenset(
+                            path for path in repo.git.ls_files("-z", "--", _PLAIN_PYS_PATHSPEC).split("\0") if path
+                        )
+                    self._plain_pys = plain_pys
+        return plain_pys
+
+    def _diff_small_file(self, file_path, is_new_file):
+        """
+        Compare a small text file with its HEAD version in process, producing hunks in the same format as git diff --unified=0.
+        A new file is compared with an empty file, since it has just been staged from the working tree.
+        Returns None when the file is too large, is not valid UTF-8, cannot be read or has its content converted by git
+        (see _get_plain_pys), so the caller falls back to git diff.
+        """
+        if file_path not in self._get_plain_pys():
+            return None
+        abs_file_path = os.path.join(self.repo.working_dir, file_path)
+        try:
+            if os.path.getsize(abs_file_path) > _IN_PROCESS_DIFF_MAX_SIZE:
+                return None
+            # newline="" 保留原始换行符，由 _split_lines 只按 "\n" 切分
+            with open(abs_file_path, "r", encoding="utf-8", newline="") as file:
+                current_lines = _split_lines(file.read())
+            if is_new_file:
+                previous_lines = []
+            else:
+                # GitPython 通过常驻的 git cat-file 进程读取对象，该进程不能被多个线程同时使用
+                with self._object_read_lock:
+                    previous_version = (
+                        (self.repo.head.commit.tree / file_path).data_stream.read()
+                    )
+                previous_lines = _split_lines(previous_version.decode("utf-8"))
+        except (OSError, KeyError, ValueError):
+            return None
 
-        return diffs
+        return _iter_unified_diff(previous_lines, current_lines)
 
-    def parse_diffs(self, diffs):
+    def parse_diffs(self, diffs, line_numbers_only=False):
         """
         Parse the difference content, extract the added and deleted object information, the object can be a class or a function.
         Output example: {'added': [(86, '    '), (87, '    def to_json_new(self, comments = True):'), (88, '        data = {'), (89, '            "name": self.node_name,')...(95, '')], 'removed': []}
@@ -88,35 +454,85 @@ class ChangeDetector:
 
         If you need to know clearly that an object is newly added, you need to use the get_added_objs() function.
         Args:
-            diffs (list): A list containing difference content. Obtained by the get_file_diff() function inside the class.
+            diffs (Iterable[str]): The lines of difference content. Obtained by the get_file_diff() function inside the class.
+            line_numbers_only (bool): If True, only the line numbers are recorded instead of (line number, content) tuples.
+                identify_changes_in_structure() only needs the line numbers, so this avoids building a tuple and a substring per changed line.
 
         Returns:
             dict: A dictionary containing added and deleted line information, the format is {'added': set(), 'removed': set()}
         """
         changed_lines = {"added": [], "removed": []}
+        add_added = changed_lines["added"].append
+        add_removed = changed_lines["removed"].append
+
+        for change_type, line_number, line in self._iter_diff_lines(diffs):
+            if change_type == "added":
+                add_added(line_number if line_numbers_only else (line_number, line[1:]))
+            else:
+                add_removed(line_number if line_numbers_only else (line_number, line[1:]))
+
+        return changed_lines
+
+    def iter_changed_lines(self, diffs):
+        """
+        Lazily parse the difference content, see parse_diffs().
+        The pairs can be passed to identify_changes_in_structure() as they are produced, without holding every changed line in memory.
+
+        Args:
+            diffs (Iterable[str]): The lines of difference content, for example the generator returned by get_file_diff().
+
+        Yields:
+            tuple: (change_type, line_number), where change_type is 'added' or 'removed'.
+        """
+        for change_type, line_number, _ in self._iter_diff_lines(diffs):
+            yield change_type, line_number
+
+    def _iter_diff_lines(self, diffs):
+        """
+        Yield the added and removed lines of the difference content together with their line numbers.
+
+        Args:
+            diffs (Iterable[str]): The lines of difference content.
+
+        Yields:
+            tuple: (change_type, line_number, line), where line still starts with the "+" or "-" marker.
+        """
         line_number_current = 0
         line_number_change = 0
 
         for line in diffs:
-            # 检测行号信息，例如 "@@ -43,33 +43,40 @@"
-            line_number_info = re.match(r"@@ \-(\d+),\d+ \+(\d+),\d+ @@", line)
-            if line_number_info:
-                line_number_current = int(line_number_info.group(1))
-                line_number_change = int(line_number_info.group(2))
+            # 按首字符分派，避免每行多次调用 startswith
+            # 分支按出现频率排列：上下文行最多，其次是增删行，行号信息只在 "@@ -" 开头的行上解析
+            first_char = line[:1]
+            if first_char == " ":
+                pass
+            elif first_char == "+":
+                if line[:3] != "+++":
+                    yield "added", line_number_change, line
+                    line_number_change += 1
+                    continue
+            elif first_char == "-":
+                if line[:3] != "---":
+                    yield "removed", line_number_current, line
+                    line_number_current += 1
+                    continue
+            elif first_char == "@":
+                # 检测行号信息，例如 "@@ -43,33 +43,40 @@"
+                if line.startswith("@@ -"):
+                    line_number_info = _parse_hunk_header(line)
+                    if line_number_info:
+                        line_number_current, line_number_change = line_number_info
+                        continue
+            elif first_char == "\\":
+                # "\ No newline at end of file" 只是标记，不对应文件中的行
                 continue
+            elif first_char == "B" and line.startswith("Binary files"):
+                # 二进制文件的 diff 只有文件头，没有可以解析的行
+                break
 
-            if line.startswith("+") and not line.startswith("+++"):
-                changed_lines["added"].append((line_number_change, line[1:]))
-                line_number_change += 1
-            elif line.startswith("-") and not line.startswith("---"):
-                changed_lines["removed"].append((line_number_current, line[1:]))
-                line_number_current += 1
-            else:
-                # 对于没有变化的行，两者的行号都需要增加
-                line_number_current += 1
-                line_number_change += 1
-
-        return changed_lines
+            # 对于没有变化的行，两者的行号都需要增加
+            line_number_current += 1
+            line_number_change += 1
 
     # TODO: The key issue is that the changed line numbers correspond to the old function names (i.e., those removed) and the new function names (i.e., those added), and the current implementation does not handle this correctly.
     # We need a way to associate the changed line numbers with their function or class names before and after the change. One method is to build a mapping before processing changed_lines, which can map the names after the change back to the names before the change based on the line number.
@@ -130,32 +546,112 @@ class ChangeDetector:
 
         Args:
             changed_lines (dict): A dictionary containing the line numbers where changes have occurred, {'added': [(line number, change content)], 'removed': [(line number, change content)]}
+                The lists may also hold plain line numbers, as returned by parse_diffs() with line_numbers_only=True.
+                An iterable of (change_type, line_number) pairs, such as iter_changed_lines(), is also accepted and consumed lazily.
             structures (list): The received is a list of function or class structures from get_functions_and_classes, each structure is composed of structure type, name, start line number, end line number, and parent structure name.
+                When the last item is not a name (get_functions_and_classes puts the parameter list there), the parent is reported as None.
 
         Returns:
             dict: A dictionary containing the structures where changes have occurred, the key is the change type, and the value is a set of structure names and parent structure names.
                 Possible change types are 'added' (new) and 'removed' (removed).
         """
         changes_in_structures = {"added": set(), "removed": set()}
-        for change_type, lines in changed_lines.items():
-            for line_number, _ in lines:
-                for (
-                    structure_type,
-                    name,
-                    start_line,
-                    end_line,
-                    parent_structure,
-                ) in structures:
-                    if start_line <= line_number <= end_line:
-                        changes_in_structures[change_type].add((name, parent_structure))
+        if not structures:
+            return changes_in_structures
+        if isinstance(changed_lines, dict):
+            # 同一行号只需查询一次
+            changed_lines = (
+                (change_type, line_number)
+                for change_type, lines in changed_lines.items()
+                for line_number in sorted(
+                    {line if type(line) is int else line[0] for line in lines}
+                )
+            )
+        # 结构按起始行排序后，与按顺序到来的变更行做一次扫描，而不是对每一行遍历全部结构
+        # 结构之间可能嵌套（类中的方法），因此用以结束行为键的最小堆维护当前覆盖该行的结构
+        # 排序后拆成起始行、结束行、(名称, 父结构) 三个并列数组，扫描时只按下标取值，不再逐个解包五元组
+        sorted_structures = sorted(structures, key=lambda structure: structure[2])
+        start_lines = [structure[2] for structure in sorted_structures]
+        end_lines = [structure[3] for structure in sorted_structures]
+        # FileHandler.get_functions_and_classes 在第五个位置放的是参数列表而不是父结构名称，列表不能放入集合，此时父结构记为 None
+        structure_keys = [
+            (structure[1], structure[4] if structure[4] is None or type(structure[4]) is str else None)
+            for structure in sorted_structures
+        ]
+        structure_count = len(start_lines)
+        # 每种变更类型各自维护扫描状态：[覆盖当前行的结构堆, 下一个待加入的结构, 上一个行号]
+        sweeps = {}
+        for change_type, line_number in changed_lines:
+            sweep = sweeps.get(change_type)
+            if sweep is None or line_number < sweep[2]:
+                # 新的变更类型，或者行号回退（输入不是按行号排序的），从头开始扫描
+                sweep = sweeps[change_type] = [[], 0, line_number]
+            active_structures, next_structure, _ = sweep
+            sweep[2] = line_number
+            # 覆盖当前行的结构集合没有变化时（连续修改同一个函数的多行），无需重复加入结果
+            active_changed = False
+            while (
+                next_structure < structure_count
+                and start_lines[next_structure] <= line_number
+            ):
+                heapq.heappush(
+                    active_structures, (end_lines[next_structure], next_structure)
+                )
+                next_structure += 1
+                active_changed = True
+            sweep[1] = next_structure
+            while active_structures and active_structures[0][0] < line_number:
+                heapq.heappop(active_structures)
+                active_changed = True
+            if active_changed:
+                changed_structures = changes_in_structures[change_type]
+                for _, index in active_structures:
+                    changed_structures.add(structure_keys[index])
         return changes_in_structures
 
+    def _get_status_entries(self):
+        """
+        Classify the files reported by a single `git status --porcelain=v2 -z` call.
+
+        In porcelain v2, ordinary entries ("1") have 8 space-separated fields before the path, renamed or copied entries ("2") have 9
+        and are followed by the original path as a separate NUL-terminated field, unmerged entries ("u") have 10, and untracked entries are "? <path>".
+        The XY field holds the staged (X) and unstaged (Y) status, where "." means unchanged.
+
+        Returns:
+            tuple: The relative file paths of the staged files (as a set), the unstaged files and the untracked files.
+        """
+        staged_files, unstaged_files, untracked_files = set(), [], []
+        entries = iter(
+            self.repo.git.status("--porcelain=v2", "-z", "--untracked-files=all").split("\0")
+        )
+        for entry in entries:
+            entry_type = entry[:1]
+            if entry_type == "?":
+                untracked_files.append(entry[2:])
+                continue
+            if entry_type == "1":
+                fields = entry.split(" ", 8)
+            elif entry_type == "2":
+                fields = entry.split(" ", 9)
+                next(entries, None)
+            elif entry_type == "u":
+                fields = entry.split(" ", 10)
+            else:
+                continue
+            staged_status, unstaged_status = fields[1]
+            path = fields[-1]
+            if staged_status != ".":
+                staged_files.add(path)
+            if unstaged_status != ".":
+                unstaged_files.append(path)
+        return staged_files, unstaged_files, untracked_files
+
     # TODO:可能有错，需要单元测试覆盖； 可能有更好的实现方式
     def get_to_be_staged_files(self):
         """
         This method retrieves all unstaged files in the repository that meet one of the following conditions:
-        1. The file, when its extension is changed to .md, corresponds to a file that is already staged.
-        2. The file's path is the same as the 'project_hierarchy' field in the CONFIG.
+        1. The file is an untracked or modified file under the markdown docs folder in the CONFIG.
+        2. The file is a modified file under the 'project_hierarchy' path in the CONFIG.
 
         It returns a list of the paths of these files.
 
@@ -163,88 +659,37 @@ class ChangeDetector:
         """
         # 已经更改但是暂未暂存的文件，这里只能是.md文件，因为作者不提交的.py文件（即使发生变更）我们不做处理。
         to_be_staged_files = []
+        add_to_be_staged = to_be_staged_files.append
+        # 一次 git status 同时得到已暂存、未暂存和未跟踪的文件，而不是分别遍历暂存区和工作区
         # staged_files是已经暂存的文件，通常这里是作者做了更改后git add 的.py文件 或其他文件
-        staged_files = [item.a_path for item in self.repo.index.diff("HEAD")]
-        print(f"{Fore.LIGHTYELLOW_EX}target_repo_path{Style.RESET_ALL}: {self.repo_path}")
-        print(f"{Fore.LIGHTMAGENTA_EX}already_staged_files{Style.RESET_ALL}:{staged_files}")
-
-        project_hierarchy = setting.project.hierarchy_name
-        # diffs是所有未暂存更改文件的列表。这些更改文件是相对于工作区（working directory）的，也就是说，它们是自上次提交（commit）以来在工作区发生的更改，但还没有被添加到暂存区（staging area）
+        # unstaged_files是所有未暂存更改文件的列表。这些更改文件是相对于工作区（working directory）的，也就是说，它们是自上次提交（commit）以来在工作区发生的更改，但还没有被添加到暂存区（staging area）
         # 比如原本存在的md文件现在由于代码的变更发生了更新，就会标记为未暂存diff
-        diffs = self.repo.index.diff(None)
         # untracked_files是一个包含了所有未跟踪文件的列表。比如说用户添加了新的.py文件后项目自己生成的对应.md文档。它们是在工作区中存在但还没有被添加到暂存区（staging area）的文件。
-        # untracked_files中的文件路径是绝对路径
-        untracked_files = self.repo.untracked_files
-        print(f"{Fore.LIGHTCYAN_EX}untracked_files{Style.RESET_ALL}: {untracked_files}")
+        # 这些文件路径都是相对于仓库根目录的路径
+        staged_files, unstaged_files, untracked_files = self._get_status_entries()
+        logger.debug("<light-yellow>target_repo_path</light-yellow>: {}", self.repo_path)
+        logger.debug("<light-magenta>already_staged_files</light-magenta>: {}", staged_files)
+        logger.debug("<light-cyan>untracked_files</light-cyan>: {}", untracked_files)
+
+        project_hierarchy = setting.project.hierarchy_name
+        markdown_docs_name = setting.project.markdown_docs_name
+        untracked_prefixes = (markdown_docs_name,)
+        unstaged_prefixes = (markdown_docs_name, project_hierarchy)
 
         # 处理untrack_files中的内容
         for untracked_file in untracked_files:
-            # 连接repo_path和untracked_file以获取完整的绝对路径
-            if untracked_file.startswith(setting.project.markdown_docs_name):
-                to_be_staged_files.append(untracked_file)
-            continue
-            print(f"rel_untracked_file:{rel_untracked_file}")
-            # import pdb; pdb.set_trace()
-            # 判断这个文件的类型：
-            if rel_untracked_file.endswith(".md"):
-                # 把rel_untracked_file从CONFIG['Markdown_Docs_folder']中拆离出来。判断是否能跟暂存区中的某一个.py文件对应上
-                rel_untracked_file = os.path.relpath(
-                    rel_untracked_file, setting.project.markdown_docs_name
-                )
-                corresponding_py_file = os.path.splitext(rel_untracked_file)[0] + ".py"
-                print(
-                    f"corresponding_py_file in untracked_files:{corresponding_py_file}"
-                )
-                if corresponding_py_file in staged_files:
-                    # 如果是，那么就把这个md文件也加入到unstaged_files中
-                    to_be_staged_files.append(
-                        os.path.join(
-                            self.repo_path.lstrip("/"),
-                            setting.project.markdown_docs_name,
-                            rel_untracked_file,
-                        )
-                    )
-            elif rel_untracked_file == project_hierarchy:
-                to_be_staged_files.append(rel_untracked_file)
+            if untracked_file.startswith(untracked_prefixes):
+                add_to_be_staged(untracked_file)
 
         # 处理已追踪但是未暂存的内容
-        unstaged_files = [diff.b_path for diff in diffs]
-        print(f"{Fore.LIGHTCYAN_EX}unstaged_files{Style.RESET_ALL}: {unstaged_files}")
+        logger.debug("<light-cyan>unstaged_files</light-cyan>: {}", unstaged_files)
 
+        # project_hierarchy 永远 add；startswith 已经覆盖了与它完全相同的路径
+        # git status 对每个路径只输出一条记录，未跟踪和未暂存的文件不会重复，因此列表中没有重复的路径
         for unstaged_file in unstaged_files:
-            # 连接repo_path和unstaged_file以获取完整的绝对路径
-            if unstaged_file.startswith(setting.project.markdown_docs_name) or unstaged_file.startswith(setting.project.hierarchy_name):
-                # abs_unstaged_file = os.path.join(self.repo_path, unstaged_file)
-                # # # 获取相对于仓库根目录的相对路径
-                # # rel_unstaged_file = os.path.relpath(abs_unstaged_file, self.repo_path)
-                to_be_staged_files.append(unstaged_file)
-            elif unstaged_file == project_hierarchy: #project_hierarchy永远add
-                to_be_staged_files.append(unstaged_file)
-            continue
-            abs_unstaged_file = os.path.join(self.repo_path, unstaged_file)
-            # 获取相对于仓库根目录的相对路径
-            rel_unstaged_file = os.path.relpath(abs_unstaged_file, self.repo_path)
-            print(f"rel_unstaged_file:{rel_unstaged_file}")
-            # 如果它是md文件
-            if unstaged_file.endswith(".md"):
-                # 把rel_unstaged_file从CONFIG['Markdown_Docs_folder']中拆离出来。判断是否能跟暂存区中的某一个.py文件对应上
-                rel_unstaged_file = os.path.relpath(
-                    rel_unstaged_file, setting.project.markdown_docs_name
-                )
-                corresponding_py_file = os.path.splitext(rel_unstaged_file)[0] + ".py"
-                print(f"corresponding_py_file:{corresponding_py_file}")
-                if corresponding_py_file in staged_files:
-                    # 如果是，那么就把这个md文件也加入到unstaged_files中
-                    to_be_staged_files.append(
-                        os.path.join(
-                            self.repo_path.lstrip("/"),
-                            setting.project.markdown_docs_name,
-                            rel_unstaged_file,
-                        )
-                    )
-            elif unstaged_file == project_hierarchy: #project_hierarchy永远add
-                to_be_staged_files.append(unstaged_file)
-        print(f"{Fore.LIGHTRED_EX}newly_staged_files{Style.RESET_ALL}: {to_be_staged_files}")
+            if unstaged_file.startswith(unstaged_prefixes):
+                add_to_be_staged(unstaged_file)
+        logger.debug("<light-red>newly_staged_files</light-red>: {}", to_be_staged_files)
         return to_be_staged_files
 
     def add_unstaged_files(self):
@@ -252,25 +697,34 @@ class ChangeDetector:
         Add unstaged files which meet the condition to the staging area.
         """
         unstaged_files_meeting_conditions = self.get_to_be_staged_files()
-        for file_path in unstaged_files_meeting_conditions:
-            add_command = f'git -C {self.repo.working_dir} add {file_path}'
-            subprocess.run(add_command, shell=True, check=True)
+        self._stage_files(unstaged_files_meeting_conditions)
         return unstaged_files_meeting_conditions
 
 
+def get_change_detector(repo_path):
+    """
+    Get the shared ChangeDetector of a repository, creating it on first use.
+    Opening a git.Repo reads the repository config and HEAD, so reusing one detector per repository avoids that work,
+    and the staged-changes caches of the detector are shared as well. Prefer this over constructing ChangeDetector directly.
+
+    Args:
+        repo_path (str | os.PathLike): The path to the repository.
+
+    Returns:
+        ChangeDetector: The detector of the repository; the same object for every spelling of the same path.
+    """
+    return _get_change_detector(os.path.realpath(repo_path))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_change_detector(repo_path):
+    return ChangeDetector(repo_path)
+
+
 if __name__ == "__main__":
     repo_path = "/path/to/your/repo/"
-    change_detector = ChangeDetector(repo_path)
+    change_detector = get_change_detector(repo_path)
     changed_files = change_detector.get_staged_pys()
     print(f"\nchanged_files:{changed_files}\n\n")
-    for file_path, is_new_file in changed_files.items():
-        changed_lines = change_detector.parse_diffs(
-            change_detector.get_file_diff(file_path, is_new_file)
-        )
-        # print("changed_lines:",changed_lines)
-        file_handler = FileHandler(repo_path=repo_path, file_path=file_path)
-        changes_in_pyfile = change_detector.identify_changes_in_structure(
-            changed_lines,
-            file_handler.get_functions_and_classes(file_handler.read_file()),
-        )
+    for file_path, changes_in_pyfile in change_detector.identify_file_changes(changed_files).items():
         print(f"Changes in {file_path} Structures:{changes_in_pyfile}\n")
@@ -1,6 +1,10 @@
+import functools
+import hashlib
 import inspect
+import json
 import os
 import sys
+import threading
 import time
 from dataclasses import dataclass
 
@@ -11,6 +15,10 @@ from repo_agent.doc_meta_info import DocItem
 from repo_agent.log import logger
 from repo_agent.prompt import SYS_PROMPT, USR_PROMPT
 from repo_agent.settings import max_input_tokens_map, setting
+from repo_agent.utils.cache_utils import ensure_local_cache_dir, prune_cache_dir
+
+# 超过该时间（秒）没有被写入或命中的回复会被清理，避免代码每次修改后产生的旧回复一直累积
+RESPONSE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
 
 
 def get_import_statements():
@@ -22,6 +30,83 @@ def get_import_statements():
     ]
     return import_lines
 
+REFERENCED_PROMPT_HEADER = "As you can see, the code calls the following objects, their code and docs are as following:"
+REFERENCER_PROMPT_HEADER = "Also, the code has been called by the following objects, their code and docs are as following:"
+
+
+def build_reference_prompt(
+    header, reference_items, missing_code, token_budget=None, num_tokens=None, documents_only=False
+):
+    """
+    Build the prompt section describing the objects a DocItem calls or is called by.
+
+    Args:
+        header (str): The first line of the section.
+        reference_items (list[DocItem]): The referenced or referencing objects.
+        missing_code (str): The text used when an object has no code content.
+        token_budget (int, optional): The maximum number of tokens of the section. When given, the shortest objects are
+            kept until the budget is used up, in their original order, and the others are left out.
+        num_tokens (Callable[[str], int], optional): Counts the tokens of a string, required with token_budget.
+        documents_only (bool): If True, objects that already have a document are described by the document alone,
+            without their raw code; the document is the summary of that code and is usually much shorter.
+
+    Returns:
+        str: The section, or an empty string when there are no objects (or none of them fits the budget).
+    """
+    if not reference_items:
+        return ""
+    # 每个对象的文本只拼接一次，最后整体 join，不再逐个 append 到列表
+    sections = [
+        f"obj: {item.get_full_name()}\nDocument: \n{item.md_content[-1]}\n=========="
+        if documents_only and item.md_content
+        else f"obj: {item.get_full_name()}\nDocument: \n{item.md_content[-1] if item.md_content else 'None'}"
+        f"\nRaw code:```\n{item.content.get('code_content', missing_code)}\n```=========="
+        for item in reference_items
+    ]
+    if token_budget is not None:
+        # 按 token 数从少到多选取，尽量多保留对象；输出时保持原来的顺序
+        section_tokens = [num_tokens(section) for section in sections]
+        used_tokens = num_tokens(header)
+        kept = set()
+        for index in sorted(range(len(sections)), key=section_tokens.__getitem__):
+            if used_tokens + section_tokens[index] > token_budget:
+                break
+            used_tokens += section_tokens[index]
+            kept.add(index)
+        if not kept:
+            return ""
+        sections = [section for index, section in enumerate(sections) if index in kept]
+    return "\n".join([header, *sections])
+
+
+def get_relationship_description(referencer_content, reference_letter):
+    if referencer_content and reference_letter:
+        return "And please include the reference relationship with its callers and callees in the project from a functional perspective"
+    elif referencer_content:
+        return "And please include the relationship with its callers in the project from a functional perspective."
+    elif reference_letter:
+        return "And please include the relationship with its callees in the project from a functional perspective."
+    else:
+        return ""
+
+
+@functools.lru_cache(maxsize=8)
+def get_openai_client(api_key, base_url, timeout):
+    """
+    Get the OpenAI client for the given connection settings, creating it on first use.
+    Reusing the client keeps its HTTP connection pool, so later requests skip the TCP and TLS handshakes.
+
+    Args:
+        api_key (str): The API key.
+        base_url (str): The base URL of the API.
+        timeout (float): The request timeout in seconds.
+
+    Returns:
+        OpenAI: The client shared by every caller with the same settings.
+    """
+    return OpenAI(api_key=api_key, base_url=base_url, timeout=timeout)
+
+
 @dataclass
 class ResponseMessage:
     content: str
@@ -32,8 +117,26 @@ class ChatEngine:
     ChatEngine is used to generate the doc of functions or classes.
     """
 
-    def __init__(self, project_manager):
+    def __init__(self, project_manager, use_response_cache=True):
+        """
+        Args:
+            project_manager (ProjectManager): The project manager used to build the project structure of a prompt.
+            use_response_cache (bool): Whether to reuse the stored response of an identical earlier request.
+                Pass False to force every document to be regenerated.
+        """
         self.project_manager = project_manager
+        self.use_response_cache = use_response_cache
+        self._response_cache_dir = os.path.join(
+            setting.project.target_repo, setting.project.hierarchy_name, "response_cache"
+        )
+        if use_response_cache:
+            self.prune_response_cache()
+        # The client is thread-safe, so one instance is shared by all worker threads and all ChatEngine instances with the same settings.
+        self.client = get_openai_client(
+            setting.chat_completion.openai_api_key.get_secret_value(),
+            str(setting.chat_completion.base_url),
+            setting.chat_completion.request_timeout,
+        )
 
     def num_tokens_from_string(self, string: str, encoding_name="cl100k_base") -> int:
         """Returns the number of tokens in a text string."""
@@ -41,27 +144,65 @@ class ChatEngine:
         num_tokens = len(encoding.encode(string))
         return num_tokens
 
-    def reduce_input_length(self, shorten_attempt, prompt_data):
+    def prune_response_cache(self):
+        """
+        Remove the stored responses that have not been used for RESPONSE_CACHE_MAX_AGE seconds.
+        """
+        prune_cache_dir(self._response_cache_dir, RESPONSE_CACHE_MAX_AGE)
+
+    def reduce_input_length(self, shorten_attempt, prompt_data, doc_item=None, max_sys_prompt_tokens=None):
         """
         Reduces the length of the input prompts by modifying the sys_prompt contents.
+
+        Args:
+            shorten_attempt (int): 0 removes the project structure, 1 additionally trims the caller and callee (reference) information.
+            prompt_data (dict): The values of SYS_PROMPT, updated in place.
+            doc_item (DocItem, optional): The object being documented. When given together with max_sys_prompt_tokens,
+                the second attempt keeps as many callers and callees as fit in the token budget instead of removing all of them.
+            max_sys_prompt_tokens (int, optional): The maximum number of tokens of the system prompt.
+
+        Returns:
+            str: The shortened system prompt.
         """
 
         logger.info(
             f"Attempt {shorten_attempt + 1} / 2 to reduce the length of the messages."
         )
-        if shorten_attempt == 0:
-            # First attempt, remove project_structure and project_structure_prefix
-            prompt_data.project_structure = ""
-            prompt_data.project_structure_prefix = ""
-        elif shorten_attempt == 1:
+        # First attempt, remove project_structure and project_structure_prefix
+        prompt_data["project_structure"] = ""
+        prompt_data["project_structure_prefix"] = ""
+        if shorten_attempt == 1:
             # Second attempt, futher remove caller and callee (reference) information
-            prompt_data.project_structure = ""
-            prompt_data.project_structure_prefix = ""
-
-            prompt_data.referenced = False
-            prompt_data.referencer_content = ""
-            prompt_data.reference_letter = ""
-            prompt_data.combine_ref_situation = ""
+            prompt_data["referencer_content"] = ""
+            prompt_data["reference_letter"] = ""
+            if doc_item is not None and max_sys_prompt_tokens is not None:
+                # 在剩余的 token 预算内尽量保留被调用者，再用余下的预算保留调用者
+                # 按最长的关系描述计算不含引用信息的 prompt 长度
+                prompt_data["has_relationship"] = get_relationship_description(True, True)
+                token_budget = max_sys_prompt_tokens - self.num_tokens_from_string(
+                    SYS_PROMPT.format(**prompt_data)
+                )
+                # 已有文档的对象只保留文档，不再附带原始代码，能放进预算的对象更多
+                reference_letter = build_reference_prompt(
+                    REFERENCED_PROMPT_HEADER, doc_item.reference_who, "",
+                    token_budget, self.num_tokens_from_string, documents_only=True,
+                )
+                token_budget -= self.num_tokens_from_string(reference_letter)
+                referencer_content = build_reference_prompt(
+                    REFERENCER_PROMPT_HEADER, doc_item.who_reference_me, "None",
+                    token_budget, self.num_tokens_from_string, documents_only=True,
+                )
+                prompt_data["reference_letter"] = reference_letter
+                prompt_data["referencer_content"] = referencer_content
+                # 分段计数与整体计数可能略有出入，超出预算时仍然去掉全部引用信息
+                if self.num_tokens_from_string(SYS_PROMPT.format(**prompt_data)) > max_sys_prompt_tokens:
+                    prompt_data["reference_letter"] = ""
+                    prompt_data["referencer_content"] = ""
+            if not prompt_data["referencer_content"]:
+                prompt_data["combine_ref_situation"] = ""
+            prompt_data["has_relationship"] = get_relationship_description(
+                prompt_data["referencer_content"], prompt_data["reference_letter"]
+            )
 
         # Update sys_prompt
         sys_prompt = SYS_PROMPT.format(**prompt_data)
@@ -69,28 +210,56 @@ class ChatEngine:
         return sys_prompt
 
     def generate_response(self, model, sys_prompt, usr_prompt, max_tokens):
-        client = OpenAI(
-            api_key=setting.chat_completion.openai_api_key.get_secret_value(),
-            base_url=str(setting.chat_completion.base_url),
-            timeout=setting.chat_completion.request_timeout,
-        )
-
         messages = [
             {"role": "system", "content": sys_prompt},
             {"role": "user", "content": usr_prompt},
         ]
+        temperature = setting.chat_completion.temperature
+
+        # 请求内容完全相同时（代码、引用关系和文档都没有变化），直接使用上次的回复，不再调用模型
+        cache_path = None
+        if self.use_response_cache:
+            # 同名模型在不同服务商处的回复不同，base_url 也是请求的一部分
+            request_key = json.dumps(
+                [str(setting.chat_completion.base_url), model, temperature, max_tokens, messages],
+                ensure_ascii=False,
+            )
+            digest = hashlib.sha256(request_key.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(self._response_cache_dir, f"{digest}.json")
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    response_message = ResponseMessage(json.load(f)["content"])
+                # 命中时更新修改时间，仍在使用的回复不会被 prune_response_cache 清理
+                os.utime(cache_path)
+                return response_message
+            except FileNotFoundError:
+                pass
 
-        response = client.chat.completions.create(
+        response = self.client.chat.completions.create(
             model=model,
             messages=messages,
-            temperature=setting.chat_completion.temperature,
+            temperature=temperature,
             max_tokens=max_tokens,
         )
 
         response_message = response.choices[0].message
 
+        if cache_path is not None and response_message.content is not None:
+            self._store_response(cache_path, response_message.content)
+
         return response_message
 
+    def _store_response(self, cache_path, content):
+        """
+        Store the content of a response in the response cache.
+        """
+        ensure_local_cache_dir(self._response_cache_dir)
+        # 多个线程可能同时写入同一个请求的回复，先写临时文件再替换，避免读到写了一半的文件
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"content": content}, f, ensure_ascii=False)
+        os.replace(temp_path, cache_path)
+
     def attempt_generate_response(
         self, model, sys_prompt, usr_prompt, max_tokens, max_attempts=5
     ):
@@ -158,45 +327,10 @@ class ChatEngine:
         # referenced = True if len(code_from_referencer) > 0 else False
         # referencer_content = '\n'.join([f'File_Path:{file_path}\n' + '\n'.join([f'Corresponding code as follows:\n{code}\n[End of this part of code]' for code in codes]) + f'\n[End of {file_path}]' for file_path, codes in code_from_referencer.items()])
 
-        def get_referenced_prompt(doc_item: DocItem) -> str:
-            if len(doc_item.reference_who) == 0:
-                return ""
-            prompt = [
-                """As you can see, the code calls the following objects, their code and docs are as following:"""
-            ]
-            for k, reference_item in enumerate(doc_item.reference_who):
-                instance_prompt = (
-                    f"""obj: {reference_item.get_full_name()}\nDocument: \n{reference_item.md_content[-1] if len(reference_item.md_content) > 0 else 'None'}\nRaw code:```\n{reference_item.content['code_content'] if 'code_content' in reference_item.content.keys() else ''}\n```"""
-                    + "=" * 10
-                )
-                prompt.append(instance_prompt)
-            return "\n".join(prompt)
-
-        def get_referencer_prompt(doc_item: DocItem) -> str:
-            if len(doc_item.who_reference_me) == 0:
-                return ""
-            prompt = [
-                """Also, the code has been called by the following objects, their code and docs are as following:"""
-            ]
-            for k, referencer_item in enumerate(doc_item.who_reference_me):
-                instance_prompt = (
-                    f"""obj: {referencer_item.get_full_name()}\nDocument: \n{referencer_item.md_content[-1] if len(referencer_item.md_content) > 0 else 'None'}\nRaw code:```\n{referencer_item.content['code_content'] if 'code_content' in referencer_item.content.keys() else 'None'}\n```"""
-                    + "=" * 10
-                )
-                prompt.append(instance_prompt)
-            return "\n".join(prompt)
-
-        def get_relationship_description(referencer_content, reference_letter):
-            if referencer_content and reference_letter:
-                return "And please include the reference relationship with its callers and callees in the project from a functional perspective"
-            elif referencer_content:
-                return "And please include the relationship with its callers in the project from a functional perspective."
-            elif reference_letter:
-                return "And please include the relationship with its callees in the project from a functional perspective."
-            else:
-                return ""
-
-        max_tokens = setting.project.max_document_tokens
+        # 配置在一次运行中不会变化，读取一次后用局部变量
+        project_settings = setting.project
+        language = project_settings.language
+        max_tokens = project_settings.max_document_tokens
 
         code_type_tell = "Class" if code_type == "ClassDef" else "Function"
         parameters_or_attribute = (
@@ -214,8 +348,12 @@ class ChatEngine:
             else ""
         )
 
-        referencer_content = get_referencer_prompt(doc_item)
-        reference_letter = get_referenced_prompt(doc_item)
+        referencer_content = build_reference_prompt(
+            REFERENCER_PROMPT_HEADER, doc_item.who_reference_me, "None"
+        )
+        reference_letter = build_reference_prompt(
+            REFERENCED_PROMPT_HEADER, doc_item.reference_who, ""
+        )
         has_relationship = get_relationship_description(
             referencer_content, reference_letter
         )
@@ -236,12 +374,12 @@ class ChatEngine:
             "reference_letter": reference_letter,
             "referencer_content": referencer_content,
             "parameters_or_attribute": parameters_or_attribute,
-            "language": setting.project.language,
+            "language": language,
         }
 
         sys_prompt = SYS_PROMPT.format(**prompt_data)
 
-        usr_prompt = USR_PROMPT.format(language=setting.project.language)
+        usr_prompt = USR_PROMPT.format(language=language)
 
         model = setting.chat_completion.model
         max_input_length = max_input_tokens_map.get(model, 4096) - max_tokens
@@ -258,8 +396,8 @@ class ChatEngine:
                 for k, v in max_input_tokens_map.items()
                 if (v - max_tokens) > total_tokens
             }  # 抽取出所有上下文长度大于当前总输入tokens的模型
-            for model_name, max_input_length in larger_models.items():
-                if max_input_length - max_tokens > total_tokens:
+            for model_name, model_input_length in larger_models.items():
+                if model_input_length - max_tokens > total_tokens:
                     try:
                         # Attempt to make a request with the larger model
                         logger.info(
@@ -274,29 +412,30 @@ class ChatEngine:
                         continue  # Try the next model
             # If no larger models succeed, fallback to original model
             # 对于最初的model模型，尝试缩减输入长度
+            usr_prompt_tokens = self.num_tokens_from_string(usr_prompt)
             for shorten_attempt in range(2):
-                shorten_success = False
-                sys_prompt = self.reduce_input_length(shorten_attempt, prompt_data)
+                sys_prompt = self.reduce_input_length(
+                    shorten_attempt,
+                    prompt_data,
+                    doc_item,
+                    max_input_length - usr_prompt_tokens - 1,
+                )
                 # 重新计算 tokens
-                total_tokens = self.num_tokens_from_string(
-                    sys_prompt
-                ) + self.num_tokens_from_string(usr_prompt)
+                total_tokens = self.num_tokens_from_string(sys_prompt) + usr_prompt_tokens
                 # 检查是否满足要求
                 if total_tokens < max_input_length:
-                    shorten_success = True
-                    # 如满足要求直接发送请求来生成文档
-                    response_message = self.attempt_generate_response(
+                    # 如满足要求直接发送请求来生成文档，不再继续缩减
+                    return self.attempt_generate_response(
                         model, sys_prompt, usr_prompt, max_tokens
                     )
 
-            if not shorten_success:
-                # 意味着这个doc_item无法生成doc（因为代码本身的长度就超过了模型的限制）
-                # 返回一个自定义的response_message对象，它的content是"Tried to generate the document, but the code is too long to process."
-                # 在其他代码调用的时候使用的是response_message.content，所以必须确保content能通过这种方式从response_message中被读取出来
-                response_message = ResponseMessage(
-                    "Tried to generate the document, but the code is too long to process."
-                )
-                return response_message
+            # 意味着这个doc_item无法生成doc（因为代码本身的长度就超过了模型的限制）
+            # 返回一个自定义的response_message对象，它的content是"Tried to generate the document, but the code is too long to process."
+            # 在其他代码调用的时候使用的是response_message.content，所以必须确保content能通过这种方式从response_message中被读取出来
+            response_message = ResponseMessage(
+                "Tried to generate the document, but the code is too long to process."
+            )
+            return response_message
 
         else:  # 如果总tokens没有超过模型限制，直接发送请求
             response_message = self.attempt_generate_response(
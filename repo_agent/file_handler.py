@@ -1,8 +1,11 @@
 # FileHandler 类，实现对文件的读写操作，这里的文件包括markdown文件和python文件
 # repo_agent/file_handler.py
 import ast
+import hashlib
 import json
 import os
+import threading
+from collections import OrderedDict
 
 import git
 from colorama import Fore, Style
@@ -12,6 +15,25 @@ from repo_agent.settings import setting
 from repo_agent.utils.gitignore_checker import GitignoreChecker
 from repo_agent.utils.meta_info_utils import latest_verison_substring
 
+# get_functions_and_classes 的解析结果缓存，键为内容的 git blob sha，内容变化后自动失效
+_STRUCTURES_CACHE_SIZE = 512
+_structures_cache = OrderedDict()
+_structures_cache_lock = threading.Lock()
+
+
+def _blob_sha(code_content):
+    """
+    Compute the git blob sha of the given content without starting a git process.
+
+    Args:
+        code_content (str): The file content.
+
+    Returns:
+        str: The hex sha1 that git would assign to a blob with this content.
+    """
+    data = code_content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
 
 class FileHandler:
     """
@@ -169,6 +191,7 @@ class FileHandler:
         Retrieves all functions, classes, their parameters (if any), and their hierarchical relationships.
         Output Examples: [('FunctionDef', 'AI_give_params', 86, 95, None, ['param1', 'param2']), ('ClassDef', 'PipelineEngine', 97, 104, None, []), ('FunctionDef', 'get_all_pys', 99, 104, 'PipelineEngine', ['param1'])]
         On the example above, PipelineEngine is the Father structure for get_all_pys.
+        Results are cached by the git blob sha of the content, so the same content is only parsed once.
 
         Args:
             code_content: The code content of the whole file to be parsed.
@@ -177,6 +200,36 @@ class FileHandler:
             A list of tuples containing the type of the node (FunctionDef, ClassDef, AsyncFunctionDef),
             the name of the node, the starting line number, the ending line number, the name of the parent node, and a list of parameters (if any).
         """
+        blob_sha = _blob_sha(code_content)
+        with _structures_cache_lock:
+            cached = _structures_cache.get(blob_sha)
+            if cached is not None:
+                _structures_cache.move_to_end(blob_sha)
+        if cached is None:
+            cached = tuple(
+                (structure_type, name, start_line, end_line, tuple(parameters))
+                for structure_type, name, start_line, end_line, parameters in self._parse_functions_and_classes(code_content)
+            )
+            with _structures_cache_lock:
+                _structures_cache[blob_sha] = cached
+                if len(_structures_cache) > _STRUCTURES_CACHE_SIZE:
+                    _structures_cache.popitem(last=False)
+        # 返回新的列表，避免调用方修改缓存中的内容
+        return [
+            (structure_type, name, start_line, end_line, list(parameters))
+            for structure_type, name, start_line, end_line, parameters in cached
+        ]
+
+    def _parse_functions_and_classes(self, code_content):
+        """
+        Parse the code content and collect its functions and classes, see get_functions_and_classes.
+
+        Args:
+            code_content: The code content of the whole file to be parsed.
+
+        Returns:
+            list: The parsed structures, uncached.
+        """
         tree = ast.parse(code_content)
         self.add_parent_references(tree)
         functions_and_classes = []
@@ -217,6 +217,12 @@ def configure():
     help="Sets the logging level (e.g., DEBUG, INFO, WARNING, ERROR, CRITICAL) for the application. Default is INFO.",
     type=click.Choice([level.value for level in LogLevel], case_sensitive=False),
 )
+@click.option(
+    "--response-cache/--no-response-cache",
+    default=setting.chat_completion.use_response_cache,
+    show_default=True,
+    help="Reuses the stored response of an identical earlier request; responses unused for 7 days are removed. Use --no-response-cache to regenerate every document.",
+)
 def run(
     model,
     temperature,
@@ -228,6 +234,7 @@ def run(
     ignore_list,
     language,
     log_level,
+    response_cache,
 ):
     """Run the program with the specified parameters."""
 
@@ -245,6 +252,7 @@ def run(
         temperature=temperature,
         request_timeout=request_timeout,
         base_url=base_url,
+        use_response_cache=response_cache,
     )
 
     settings = Setting(
@@ -10,7 +10,7 @@ from functools import partial
 from colorama import Fore, Style
 from tqdm import tqdm
 
-from repo_agent.change_detector import ChangeDetector
+from repo_agent.change_detector import get_change_detector
 from repo_agent.chat_engine import ChatEngine
 from repo_agent.doc_meta_info import DocItem, DocItemStatus, MetaInfo, need_to_generate
 from repo_agent.file_handler import FileHandler
@@ -29,8 +29,11 @@ class Runner:
             repo_path=setting.project.target_repo, 
             project_hierarchy=setting.project.hierarchy_name
         )
-        self.change_detector = ChangeDetector(repo_path=setting.project.target_repo)
-        self.chat_engine = ChatEngine(project_manager=self.project_manager)
+        self.change_detector = get_change_detector(setting.project.target_repo)
+        self.chat_engine = ChatEngine(
+            project_manager=self.project_manager,
+            use_response_cache=setting.chat_completion.use_response_cache,
+        )
 
         
         if not self.absolute_project_hierarchy_path.exists():
@@ -219,8 +222,7 @@ class Runner:
     def git_commit(self, commit_message):
         try:
             subprocess.check_call(
-                ["git", "commit", "--no-verify", "-m", commit_message],
-                shell=True,
+                ["git", "commit", "--no-verify", "-m", commit_message]
             )
         except subprocess.CalledProcessError as e:
             print(f"An error occurred while trying to commit {str(e)}")
@@ -381,7 +383,8 @@ class Runner:
         # 获取整个py文件的代码
         source_code = file_handler.read_file()
         changed_lines = self.change_detector.parse_diffs(
-            self.change_detector.get_file_diff(file_path, is_new_file)
+            self.change_detector.get_file_diff(file_path, is_new_file),
+            line_numbers_only=True,
         )
         changes_in_pyfile = self.change_detector.identify_changes_in_structure(
             changed_lines, file_handler.get_functions_and_classes(source_code)
@@ -72,6 +72,7 @@ class ChatCompletionSettings(BaseSettings):
     request_timeout: PositiveFloat = 60.0
     base_url: HttpUrl = "https://api.openai.com/v1"  # type: ignore
     openai_api_key: SecretStr = Field(..., exclude=True)
+    use_response_cache: bool = True
 
     @field_serializer("base_url")
     def serialize_base_url(self, base_url: HttpUrl):
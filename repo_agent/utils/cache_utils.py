@@ -0,0 +1,46 @@
+import os
+import time
+
+
+def ensure_local_cache_dir(cache_dir):
+    """
+    Create a cache directory inside the target repository if it does not exist yet.
+
+    The directory gets a .gitignore that ignores everything in it, so the cache is only used locally
+    and never shows up among the untracked files of the repository.
+
+    Args:
+        cache_dir (str): The path of the cache directory.
+    """
+    if os.path.exists(cache_dir):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, ".gitignore"), "w", encoding="utf-8") as f:
+        f.write("*\n")
+
+
+def prune_cache_dir(cache_dir, max_age):
+    """
+    Remove the entries of a cache directory that have not been written or used for longer than max_age.
+
+    Callers refresh the modification time of an entry whenever they use it, so only entries that are no longer
+    requested expire. Leftover temporary files of interrupted writes are removed the same way.
+
+    Args:
+        cache_dir (str): The path of the cache directory.
+        max_age (float): The maximum age of an entry in seconds.
+    """
+    try:
+        entries = list(os.scandir(cache_dir))
+    except OSError:
+        return
+    expire_before = time.time() - max_age
+    for entry in entries:
+        if entry.name == ".gitignore":
+            continue
+        try:
+            if entry.is_file() and entry.stat().st_mtime < expire_before:
+                os.remove(entry.path)
+        except OSError:
+            # 其他进程可能同时清理或替换了这个文件
+            continue
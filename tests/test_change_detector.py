@@ -1,6 +1,6 @@
 import unittest
 import os
-from repo_agent.change_detector import ChangeDetector
+from repo_agent.change_detector import ChangeDetector, get_change_detector
 from git import Repo
 
 class TestChangeDetector(unittest.TestCase):
@@ -82,6 +82,315 @@ class TestChangeDetector(unittest.TestCase):
         print(f"\ntest_add_unstaged_mds: Number of remaining unstaged Markdown files after add: {remaining_unstaged_files}")
 
 
+    def test_parse_diffs(self):
+        diffs = [
+            "diff --git a/test_file.py b/test_file.py",
+            "--- a/test_file.py",
+            "+++ b/test_file.py",
+            "@@ -1,3 +1,3 @@",
+            " import os",
+            "-print('old')",
+            "+print('new')",
+            " print('tail')",
+            "@@ -10,2 +10,3 @@",
+            " x = 1",
+            "+y = 2",
+            "--z = 3",
+        ]
+
+        change_detector = ChangeDetector(self.test_repo_path)
+        changed_lines = change_detector.parse_diffs(diffs)
+
+        self.assertEqual(changed_lines["added"], [(2, "print('new')"), (11, "y = 2")])
+        self.assertEqual(changed_lines["removed"], [(2, "print('old')"), (11, "-z = 3")])
+
+    def test_parse_diffs_line_numbers_only(self):
+        diffs = ["@@ -3,2 +3,0 @@", "-a = 1", "-b = 2", "@@ -8 +6,2 @@", "-c = 3", "+c = 4", "+d = 5"]
+
+        change_detector = ChangeDetector(self.test_repo_path)
+        changed_lines = change_detector.parse_diffs(diffs, line_numbers_only=True)
+
+        self.assertEqual(changed_lines, {"added": [6, 7], "removed": [3, 4, 8]})
+        changes_in_structures = change_detector.identify_changes_in_structure(
+            changed_lines, [("FunctionDef", "func", 5, 7, None)]
+        )
+        self.assertEqual(changes_in_structures, {"added": {("func", None)}, "removed": set()})
+
+    def test_parse_binary_diffs(self):
+        diffs = [
+            "diff --git a/image.png b/image.png",
+            "index 1234567..89abcde 100644",
+            "Binary files a/image.png and b/image.png differ",
+        ]
+
+        change_detector = ChangeDetector(self.test_repo_path)
+        changed_lines = change_detector.parse_diffs(diffs)
+
+        self.assertEqual(changed_lines, {"added": [], "removed": []})
+
+    def test_get_file_diff(self):
+        # 创建一个新的 Python 文件，get_file_diff 会先暂存它再读取 diff
+        diff_py_file = os.path.join(self.test_repo_path, 'diff_test_file.py')
+        with open(diff_py_file, 'w') as f:
+            f.write('import os\n\nprint(os.getcwd())\n')
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            changed_lines = change_detector.parse_diffs(
+                change_detector.get_file_diff('diff_test_file.py', True)
+            )
+        finally:
+            self.repo.git.rm('--cached', '-f', 'diff_test_file.py')
+            os.remove(diff_py_file)
+
+        self.assertEqual(
+            changed_lines["added"],
+            [(1, 'import os'), (2, ''), (3, 'print(os.getcwd())')],
+        )
+        self.assertEqual(changed_lines["removed"], [])
+
+    def test_get_file_diff_of_modified_file(self):
+        # 修改已提交的单行文件，git 会省略 hunk 头中的行数，例如 "@@ -1 +1 @@"
+        py_file = os.path.join(self.test_repo_path, 'test_file.py')
+        with open(py_file, 'w') as f:
+            f.write('print("Hello, Diff")')
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            changed_lines = change_detector.parse_diffs(
+                change_detector.get_file_diff('test_file.py', False)
+            )
+        finally:
+            self.repo.git.checkout('--', 'test_file.py')
+
+        self.assertEqual(changed_lines["added"], [(1, 'print("Hello, Diff")')])
+        self.assertEqual(changed_lines["removed"], [(1, 'print("Hello, Python")')])
+
+    def test_get_file_diff_with_form_feed(self):
+        # 换页符不是 git 和 ast 的换行符，进程内 diff 的行号必须与 git diff 一致
+        py_file = os.path.join(self.test_repo_path, 'form_feed_file.py')
+        with open(py_file, 'w', newline='') as f:
+            f.write('import os\n\x0c\ndef first():\n    return 1\n\n\ndef second():\n    return 2\n')
+        self.repo.git.add('form_feed_file.py')
+        self.repo.git.commit('-m', 'Add form feed file')
+
+        try:
+            with open(py_file, 'w', newline='') as f:
+                f.write('import os\n\x0c\ndef first():\n    return 1\n\n\ndef second():\n    return 3\n')
+            change_detector = ChangeDetector(self.test_repo_path)
+            changed_lines = change_detector.parse_diffs(
+                change_detector.get_file_diff('form_feed_file.py', False)
+            )
+            git_changed_lines = change_detector.parse_diffs(
+                self.repo.git.diff('--unified=0', 'HEAD', '--', 'form_feed_file.py').split('\n')
+            )
+            changes = change_detector.identify_file_changes({'form_feed_file.py': False})
+        finally:
+            self.repo.git.reset('--soft', 'HEAD~1')
+            self.repo.git.rm('--cached', '-f', 'form_feed_file.py')
+            os.remove(py_file)
+
+        self.assertEqual(changed_lines, git_changed_lines)
+        self.assertEqual(changed_lines["added"], [(8, '    return 3')])
+        self.assertEqual(
+            changes,
+            {'form_feed_file.py': {"added": {("second", None)}, "removed": {("second", None)}}},
+        )
+
+    def test_get_file_diff_with_autocrlf(self):
+        # core.autocrlf=true（Git for Windows 的默认值）时 HEAD 中是 LF，工作区是 CRLF，只有真正修改的行算作变更
+        py_file = os.path.join(self.test_repo_path, 'autocrlf_file.py')
+        with open(py_file, 'w', newline='') as f:
+            f.write('def a():\n    return 1\n\n\ndef b():\n    return 2\n')
+        self.repo.git.add('autocrlf_file.py')
+        self.repo.git.commit('-m', 'Add autocrlf file')
+        self.repo.git.config('core.autocrlf', 'true')
+
+        try:
+            with open(py_file, 'w', newline='') as f:
+                f.write('def a():\r\n    return 1\r\n\r\n\r\ndef b():\r\n    return 3\r\n')
+            change_detector = ChangeDetector(self.test_repo_path)
+            changed_lines = change_detector.parse_diffs(
+                change_detector.get_file_diff('autocrlf_file.py', False)
+            )
+            changes = change_detector.identify_file_changes({'autocrlf_file.py': False})
+        finally:
+            self.repo.git.config('--unset', 'core.autocrlf')
+            self.repo.git.reset('--soft', 'HEAD~1')
+            self.repo.git.rm('--cached', '-f', 'autocrlf_file.py')
+            os.remove(py_file)
+
+        self.assertEqual(changed_lines, {"added": [(6, '    return 3')], "removed": [(6, '    return 2')]})
+        self.assertEqual(
+            changes,
+            {'autocrlf_file.py': {"added": {("b", None)}, "removed": {("b", None)}}},
+        )
+
+    def test_files_with_eol_attributes_are_diffed_by_git(self):
+        attributes_file = os.path.join(self.test_repo_path, '.gitattributes')
+        with open(attributes_file, 'w') as f:
+            f.write('eol_file.py eol=crlf\n')
+        for file_name in ('eol_file.py', 'plain_file.py'):
+            with open(os.path.join(self.test_repo_path, file_name), 'w') as f:
+                f.write('value = 1\n')
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            change_detector._stage_files(['eol_file.py', 'plain_file.py'])
+            plain_pys = change_detector._get_plain_pys()
+        finally:
+            self.repo.git.rm('--cached', '-f', 'eol_file.py', 'plain_file.py')
+            for file_name in ('eol_file.py', 'plain_file.py', '.gitattributes'):
+                os.remove(os.path.join(self.test_repo_path, file_name))
+
+        self.assertIn('plain_file.py', plain_pys)
+        self.assertNotIn('eol_file.py', plain_pys)
+
+    def test_get_file_diffs(self):
+        # 同时读取多个新文件的 diff
+        file_names = ['diffs_test_a.py', 'diffs_test_b.py']
+        for file_name in file_names:
+            with open(os.path.join(self.test_repo_path, file_name), 'w') as f:
+                f.write(f'name = "{file_name}"\nprint(name)\n')
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            file_diffs = change_detector.get_file_diffs(
+                {file_name: True for file_name in file_names}
+            )
+        finally:
+            self.repo.git.rm('--cached', '-f', *file_names)
+            for file_name in file_names:
+                os.remove(os.path.join(self.test_repo_path, file_name))
+
+        self.assertEqual(sorted(file_diffs), file_names)
+        for file_name in file_names:
+            changed_lines = change_detector.parse_diffs(file_diffs[file_name])
+            self.assertEqual(
+                changed_lines["added"], [(1, f'name = "{file_name}"'), (2, 'print(name)')]
+            )
+
+    def test_parse_file_diffs(self):
+        # 在线程池中同时读取并解析多个新文件的 diff
+        file_names = ['parse_test_a.py', 'parse_test_b.py']
+        for file_name in file_names:
+            with open(os.path.join(self.test_repo_path, file_name), 'w') as f:
+                f.write(f'name = "{file_name}"\n')
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            file_changed_lines = change_detector.parse_file_diffs(
+                {file_name: True for file_name in file_names}
+            )
+        finally:
+            self.repo.git.rm('--cached', '-f', *file_names)
+            for file_name in file_names:
+                os.remove(os.path.join(self.test_repo_path, file_name))
+
+        self.assertEqual(
+            file_changed_lines,
+            {
+                file_name: {"added": [(1, f'name = "{file_name}"')], "removed": []}
+                for file_name in file_names
+            },
+        )
+
+    def test_parse_file_diffs_of_large_files(self):
+        # 超过进程内 diff 大小限制的文件会合并到一次 git diff 中
+        file_names = ['large_test_a.py', 'large_test_b.py']
+        content = ''.join(f'value_{index} = {index}\n' for index in range(5000))
+        for file_name in file_names:
+            with open(os.path.join(self.test_repo_path, file_name), 'w') as f:
+                f.write(content)
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            file_changed_lines = change_detector.parse_file_diffs(
+                {file_name: True for file_name in file_names}
+            )
+        finally:
+            self.repo.git.rm('--cached', '-f', *file_names)
+            for file_name in file_names:
+                os.remove(os.path.join(self.test_repo_path, file_name))
+
+        self.assertEqual(sorted(file_changed_lines), file_names)
+        for file_name in file_names:
+            changed_lines = file_changed_lines[file_name]
+            self.assertEqual(len(changed_lines["added"]), 5000)
+            self.assertEqual(changed_lines["added"][-1], (5000, 'value_4999 = 4999'))
+            self.assertEqual(changed_lines["removed"], [])
+
+    def test_identify_file_changes(self):
+        # 在线程池中完成 diff、结构解析和变更结构识别
+        py_file = os.path.join(self.test_repo_path, 'test_file.py')
+        with open(py_file, 'w') as f:
+            f.write('print("Hello, Python")\n\ndef greet():\n    return "Hello"\n')
+
+        try:
+            change_detector = ChangeDetector(self.test_repo_path)
+            changes = change_detector.identify_file_changes({'test_file.py': False})
+        finally:
+            self.repo.git.checkout('--', 'test_file.py')
+
+        self.assertEqual(
+            changes, {'test_file.py': {"added": {("greet", None)}, "removed": set()}}
+        )
+
+    def test_identify_changes_in_structure(self):
+        changed_lines = {
+            "added": [(3, "        return 1"), (12, "x = 1"), (20, "    pass")],
+            "removed": [(8, "    def old(self):")],
+        }
+        structures = [
+            ("FunctionDef", "helper", 18, 21, None),
+            ("ClassDef", "Outer", 1, 10, None),
+            ("FunctionDef", "method", 2, 4, "Outer"),
+            ("FunctionDef", "other", 6, 9, "Outer"),
+        ]
+
+        change_detector = ChangeDetector(self.test_repo_path)
+        changes_in_structures = change_detector.identify_changes_in_structure(
+            changed_lines, structures
+        )
+
+        self.assertEqual(
+            changes_in_structures["added"],
+            {("Outer", None), ("method", "Outer"), ("helper", None)},
+        )
+        self.assertEqual(
+            changes_in_structures["removed"], {("Outer", None), ("other", "Outer")}
+        )
+
+    def test_iter_changed_lines(self):
+        diffs = ["@@ -3,2 +3,0 @@", "-a = 1", "-b = 2", "@@ -8 +6,2 @@", "-c = 3", "+c = 4", "+d = 5"]
+        structures = [("FunctionDef", "func", 5, 7, None), ("FunctionDef", "other", 1, 3, None)]
+
+        change_detector = ChangeDetector(self.test_repo_path)
+        changed_lines = list(change_detector.iter_changed_lines(diffs))
+
+        self.assertEqual(
+            changed_lines,
+            [("removed", 3), ("removed", 4), ("removed", 8), ("added", 6), ("added", 7)],
+        )
+        # 直接消费生成器与先构建字典的结果一致
+        self.assertEqual(
+            change_detector.identify_changes_in_structure(
+                change_detector.iter_changed_lines(diffs), structures
+            ),
+            change_detector.identify_changes_in_structure(
+                change_detector.parse_diffs(diffs, line_numbers_only=True), structures
+            ),
+        )
+
+    def test_get_change_detector(self):
+        change_detector = get_change_detector(self.test_repo_path)
+
+        # 同一个仓库的不同写法返回同一个实例
+        self.assertIs(
+            get_change_detector(os.path.join(self.test_repo_path, '.')), change_detector
+        )
+        self.assertIsInstance(change_detector, ChangeDetector)
+
     @classmethod
     def tearDownClass(cls):
         # 清理测试仓库
@@ -0,0 +1,331 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from repo_agent.chat_engine import (
+    REFERENCED_PROMPT_HEADER,
+    REFERENCER_PROMPT_HEADER,
+    RESPONSE_CACHE_MAX_AGE,
+    ChatEngine,
+    build_reference_prompt,
+    get_relationship_description,
+)
+from repo_agent.prompt import SYS_PROMPT
+from repo_agent.settings import setting
+
+
+def num_tokens(string):
+    # 用空白分隔的单词数代替 tiktoken 的计数，测试不需要下载编码文件
+    return len(string.split())
+
+
+def make_reference_item(name, code_words, document=None):
+    return SimpleNamespace(
+        get_full_name=lambda: name,
+        md_content=[document] if document else [],
+        content={"code_content": " ".join(["code"] * code_words)},
+    )
+
+
+class TestChatEngineResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_root = tempfile.mkdtemp()
+        self.requests = []
+
+        def create(**kwargs):
+            # 记录每次请求，返回与请求次数对应的回复
+            self.requests.append(kwargs)
+            message = SimpleNamespace(content=f"response {len(self.requests)}")
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+        self.client = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_root)
+
+    def make_chat_engine(self, use_response_cache=True):
+        chat_engine = ChatEngine(project_manager=None, use_response_cache=use_response_cache)
+        chat_engine._response_cache_dir = os.path.join(self.cache_root, "response_cache")
+        chat_engine.client = self.client
+        return chat_engine
+
+    def cache_files(self, chat_engine):
+        cache_dir = chat_engine._response_cache_dir
+        return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".json")]
+
+    def test_cache_miss_calls_model_and_stores_response(self):
+        chat_engine = self.make_chat_engine()
+        response = chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+
+        self.assertEqual(response.content, "response 1")
+        self.assertEqual(len(self.requests), 1)
+        cache_files = os.listdir(chat_engine._response_cache_dir)
+        self.assertIn(".gitignore", cache_files)
+        self.assertEqual(len([name for name in cache_files if name.endswith(".json")]), 1)
+        self.assertFalse([name for name in cache_files if name.endswith(".tmp")])
+
+    def test_cache_hit_reuses_response(self):
+        self.make_chat_engine().generate_response("gpt-4", "sys", "usr", 100)
+        # 新的 ChatEngine 也能读到之前保存的回复
+        response = self.make_chat_engine().generate_response("gpt-4", "sys", "usr", 100)
+
+        self.assertEqual(response.content, "response 1")
+        self.assertEqual(len(self.requests), 1)
+
+    def test_changed_request_misses_cache(self):
+        chat_engine = self.make_chat_engine()
+        chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+        response = chat_engine.generate_response("gpt-4", "sys", "changed usr", 100)
+
+        self.assertEqual(response.content, "response 2")
+        self.assertEqual(len(self.requests), 2)
+
+    def test_cache_off(self):
+        chat_engine = self.make_chat_engine(use_response_cache=False)
+        chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+        response = chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+
+        self.assertEqual(response.content, "response 2")
+        self.assertEqual(len(self.requests), 2)
+        self.assertFalse(os.path.exists(chat_engine._response_cache_dir))
+
+    def test_changed_base_url_misses_cache(self):
+        base_url = setting.chat_completion.base_url
+        chat_engine = self.make_chat_engine()
+        chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+        try:
+            # 另一个服务商提供的同名模型
+            setting.chat_completion.base_url = "https://other-provider.example/v1"
+            response = chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+        finally:
+            setting.chat_completion.base_url = base_url
+
+        self.assertEqual(response.content, "response 2")
+        self.assertEqual(len(self.requests), 2)
+
+    def test_cache_hit_refreshes_entry(self):
+        chat_engine = self.make_chat_engine()
+        chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+        cache_path = self.cache_files(chat_engine)[0]
+        old_time = time.time() - RESPONSE_CACHE_MAX_AGE + 60
+        os.utime(cache_path, (old_time, old_time))
+
+        chat_engine.generate_response("gpt-4", "sys", "usr", 100)
+
+        self.assertGreater(os.path.getmtime(cache_path), old_time)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_prune_removes_expired_entries(self):
+        chat_engine = self.make_chat_engine()
+        chat_engine.generate_response("gpt-4", "sys", "old", 100)
+        expired_path = self.cache_files(chat_engine)[0]
+        expired_time = time.time() - RESPONSE_CACHE_MAX_AGE - 60
+        os.utime(expired_path, (expired_time, expired_time))
+        chat_engine.generate_response("gpt-4", "sys", "new", 100)
+
+        chat_engine.prune_response_cache()
+
+        cache_files = self.cache_files(chat_engine)
+        self.assertEqual(len(cache_files), 1)
+        self.assertNotIn(expired_path, cache_files)
+        self.assertTrue(os.path.exists(os.path.join(chat_engine._response_cache_dir, ".gitignore")))
+
+
+class TestReferencePrompt(unittest.TestCase):
+    def setUp(self):
+        # 原始顺序中最长的对象在中间，最短的在最后
+        self.reference_items = [
+            make_reference_item("medium", 20),
+            make_reference_item("long", 60),
+            make_reference_item("short", 5),
+        ]
+        self.header_tokens = num_tokens(REFERENCED_PROMPT_HEADER)
+        self.section_tokens = {
+            item.get_full_name(): num_tokens(build_reference_prompt("", [item], "")) for item in self.reference_items
+        }
+
+    def test_without_budget_keeps_all_references(self):
+        prompt = build_reference_prompt(REFERENCED_PROMPT_HEADER, self.reference_items, "")
+        self.assertEqual(
+            [line for line in prompt.split("\n") if line.startswith("obj: ")],
+            ["obj: medium", "obj: long", "obj: short"],
+        )
+
+    def test_keeps_shortest_references_in_original_order(self):
+        token_budget = self.header_tokens + self.section_tokens["medium"] + self.section_tokens["short"]
+        prompt = build_reference_prompt(
+            REFERENCED_PROMPT_HEADER, self.reference_items, "", token_budget, num_tokens
+        )
+
+        self.assertTrue(prompt.startswith(REFERENCED_PROMPT_HEADER))
+        self.assertEqual(
+            [line for line in prompt.split("\n") if line.startswith("obj: ")],
+            ["obj: medium", "obj: short"],
+        )
+        self.assertLessEqual(num_tokens(prompt), token_budget)
+
+    def test_drops_all_references_when_none_fits(self):
+        token_budget = self.header_tokens + self.section_tokens["short"] - 1
+        prompt = build_reference_prompt(
+            REFERENCED_PROMPT_HEADER, self.reference_items, "", token_budget, num_tokens
+        )
+        self.assertEqual(prompt, "")
+
+    def test_documents_only_leaves_out_code_of_documented_references(self):
+        reference_items = [
+            make_reference_item("documented", 60, "short doc"),
+            make_reference_item("undocumented", 5),
+        ]
+        prompt = build_reference_prompt(REFERENCED_PROMPT_HEADER, reference_items, "", documents_only=True)
+
+        self.assertIn("obj: documented\nDocument: \nshort doc\n==========", prompt)
+        self.assertEqual(prompt.count("Raw code:"), 1)
+        self.assertNotIn("code " * 60, prompt)
+
+    def test_documents_only_keeps_shortest_references_in_original_order(self):
+        # 代码都很长，按文档长度选取
+        reference_items = [
+            make_reference_item("medium_doc", 100, " ".join(["doc"] * 20)),
+            make_reference_item("long_doc", 100, " ".join(["doc"] * 60)),
+            make_reference_item("short_doc", 100, " ".join(["doc"] * 5)),
+        ]
+        section_tokens = {
+            item.get_full_name(): num_tokens(build_reference_prompt("", [item], "", documents_only=True))
+            for item in reference_items
+        }
+        token_budget = self.header_tokens + section_tokens["medium_doc"] + section_tokens["short_doc"]
+        prompt = build_reference_prompt(
+            REFERENCED_PROMPT_HEADER, reference_items, "", token_budget, num_tokens, documents_only=True
+        )
+
+        self.assertEqual(
+            [line for line in prompt.split("\n") if line.startswith("obj: ")],
+            ["obj: medium_doc", "obj: short_doc"],
+        )
+        self.assertNotIn("Raw code:", prompt)
+        self.assertLessEqual(num_tokens(prompt), token_budget)
+
+        token_budget = self.header_tokens + section_tokens["short_doc"] - 1
+        self.assertEqual(
+            build_reference_prompt(
+                REFERENCED_PROMPT_HEADER, reference_items, "", token_budget, num_tokens, documents_only=True
+            ),
+            "",
+        )
+
+
+class TestReduceInputLength(unittest.TestCase):
+    def setUp(self):
+        self.chat_engine = ChatEngine(project_manager=None)
+        self.chat_engine.num_tokens_from_string = num_tokens
+        self.doc_item = SimpleNamespace(
+            reference_who=[
+                make_reference_item("callee_medium", 10),
+                make_reference_item("callee_long", 80),
+                make_reference_item("callee_short", 5),
+            ],
+            who_reference_me=[
+                make_reference_item("caller_short", 5),
+                make_reference_item("caller_long", 80),
+            ],
+        )
+
+    def make_prompt_data(self):
+        reference_letter = build_reference_prompt(REFERENCED_PROMPT_HEADER, self.doc_item.reference_who, "")
+        referencer_content = build_reference_prompt(REFERENCER_PROMPT_HEADER, self.doc_item.who_reference_me, "None")
+        return {
+            "combine_ref_situation": "and combine it with its calling situation in the project,",
+            "file_path": "module.py",
+            "project_structure_prefix": ", and the related hierarchical structure of this project is as follows:",
+            "project_structure": "module.py\n  *target",
+            "code_type_tell": "Function",
+            "code_name": "target",
+            "code_content": "def target():\n    return 1",
+            "have_return_tell": "",
+            "has_relationship": get_relationship_description(referencer_content, reference_letter),
+            "reference_letter": reference_letter,
+            "referencer_content": referencer_content,
+            "parameters_or_attribute": "parameters",
+            "language": "English",
+        }
+
+    def base_prompt_tokens(self):
+        # 不含引用信息、按最长的关系描述计算的 prompt 长度
+        prompt_data = self.make_prompt_data()
+        prompt_data.update(
+            project_structure="",
+            project_structure_prefix="",
+            reference_letter="",
+            referencer_content="",
+            has_relationship=get_relationship_description(True, True),
+        )
+        return num_tokens(SYS_PROMPT.format(**prompt_data))
+
+    def test_keeps_shortest_references_within_budget(self):
+        callee_medium, _, callee_short = self.doc_item.reference_who
+        caller_short = self.doc_item.who_reference_me[0]
+        max_sys_prompt_tokens = (
+            self.base_prompt_tokens()
+            + num_tokens(REFERENCED_PROMPT_HEADER)
+            + num_tokens(REFERENCER_PROMPT_HEADER)
+            + sum(num_tokens(build_reference_prompt("", [item], "")) for item in (callee_medium, callee_short, caller_short))
+        )
+        prompt_data = self.make_prompt_data()
+        sys_prompt = self.chat_engine.reduce_input_length(
+            1, prompt_data, self.doc_item, max_sys_prompt_tokens
+        )
+
+        self.assertLessEqual(num_tokens(sys_prompt), max_sys_prompt_tokens)
+        self.assertEqual(
+            [line for line in sys_prompt.split("\n") if line.startswith("obj: ")],
+            ["obj: callee_medium", "obj: callee_short", "obj: caller_short"],
+        )
+        self.assertEqual(prompt_data["project_structure"], "")
+        self.assertEqual(prompt_data["has_relationship"], get_relationship_description(True, True))
+
+    def test_keeps_documents_of_references_without_their_code(self):
+        # 有文档的长代码对象只保留文档，放得进预算
+        self.doc_item.reference_who[1].md_content = ["callee doc"]
+        callee_long = self.doc_item.reference_who[1]
+        max_sys_prompt_tokens = (
+            self.base_prompt_tokens()
+            + num_tokens(REFERENCED_PROMPT_HEADER)
+            + num_tokens(build_reference_prompt("", [callee_long], "", documents_only=True))
+        )
+        prompt_data = self.make_prompt_data()
+        sys_prompt = self.chat_engine.reduce_input_length(
+            1, prompt_data, self.doc_item, max_sys_prompt_tokens
+        )
+
+        self.assertLessEqual(num_tokens(sys_prompt), max_sys_prompt_tokens)
+        self.assertEqual(
+            [line for line in sys_prompt.split("\n") if line.startswith("obj: ")],
+            ["obj: callee_long"],
+        )
+        self.assertIn("callee doc", sys_prompt)
+        self.assertNotIn("Raw code:", sys_prompt)
+        self.assertEqual(prompt_data["referencer_content"], "")
+        self.assertEqual(prompt_data["has_relationship"], get_relationship_description(False, True))
+
+    def test_drops_all_references_when_none_fits(self):
+        max_sys_prompt_tokens = self.base_prompt_tokens() + 1
+        prompt_data = self.make_prompt_data()
+        sys_prompt = self.chat_engine.reduce_input_length(
+            1, prompt_data, self.doc_item, max_sys_prompt_tokens
+        )
+
+        self.assertLessEqual(num_tokens(sys_prompt), max_sys_prompt_tokens)
+        self.assertNotIn("obj: ", sys_prompt)
+        self.assertEqual(prompt_data["reference_letter"], "")
+        self.assertEqual(prompt_data["referencer_content"], "")
+        self.assertEqual(prompt_data["combine_ref_situation"], "")
+        self.assertEqual(prompt_data["has_relationship"], "")
+
+
+if __name__ == '__main__':
+    unittest.main()